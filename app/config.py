@@ -4,115 +4,271 @@ Loads templates from JSON and environment variables
 """
 
 import os
-import json
-from typing import Dict, Any, Optional
-from pydantic import BaseModel
-from termcolor import colored
+import hashlib
+import logging
+import secrets
+import orjson
+from dataclasses import dataclass, field
+from functools import lru_cache
+from pathlib import Path
+from types import MappingProxyType
+from typing import Callable, Dict, Any, Iterable, Mapping, Optional, Tuple
+from pydantic import BaseModel, ConfigDict, TypeAdapter
 
+from app.models import HealthResponse, TemplateInfo, TemplatesListResponse
+
+logger = logging.getLogger(__name__)
 
 class TemplateConfig(BaseModel):
     """Configuration for a single invoice template"""
+    model_config = ConfigDict(frozen=True)
+    
     generator_id: int
     subject_id: int
     due_days: int = 14
     description: Optional[str] = None
 
 
+# Validates the whole templates mapping in one pydantic-core call
+_TEMPLATES_ADAPTER = TypeAdapter(Dict[str, TemplateConfig])
+
+
+def _digest(value: str) -> bytes:
+    """SHA-256 digest of a credential"""
+    return hashlib.sha256(value.encode("utf-8")).digest()
+
+
+def etag_for(body: bytes) -> str:
+    """
+    Weak ETag (quoted BLAKE2b hash) of a response body
+    
+    Weak, since GZipMiddleware may send the same body gzip-encoded under it
+    """
+    return f'W/"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+
+
+def find_first_file(paths: Iterable[str]) -> Optional[Path]:
+    """Return the first of paths that is an existing file, None if none is"""
+    return next((path for path in map(Path, paths) if path.is_file()), None)
+
+
+# Environment variables snapshotted once at config construction
+_ENV_KEYS = (
+    # Fakturoid API credentials
+    "FAKTUROID_CLIENT_ID",
+    "FAKTUROID_CLIENT_SECRET",
+    "FAKTUROID_ACCOUNT_SLUG",
+    "USER_AGENT",
+    "TEMPLATES_PATH",
+    # API Basic Auth credentials
+    "API_USERNAME",
+    "API_PASSWORD",
+    # Comma-separated browser origins allowed by CORS
+    "CORS_ORIGINS",
+)
+
+_ENV_DEFAULTS = {
+    "USER_AGENT": "FakturoidBot (bot@example.com)",
+    "TEMPLATES_PATH": "/app/config/templates.json",
+    "CORS_ORIGINS": "",
+}
+
+_REQUIRED_ENV = (
+    "FAKTUROID_CLIENT_ID",
+    "FAKTUROID_CLIENT_SECRET",
+    "FAKTUROID_ACCOUNT_SLUG",
+    "API_USERNAME",
+    "API_PASSWORD",
+)
+
+
+@dataclass(slots=True)
 class AppConfig:
-    """Application configuration singleton"""
+    """
+    Application configuration, read from the environment once per process
     
-    _instance: Optional["AppConfig"] = None
+    Environment values are fixed after construction. Templates and the
+    state derived from them are replaced by reload_templates().
+    """
     
-    def __new__(cls):
-        if cls._instance is None:
-            cls._instance = super().__new__(cls)
-            cls._instance._initialized = False
-        return cls._instance
+    FAKTUROID_CLIENT_ID: Optional[str] = field(init=False)
+    FAKTUROID_CLIENT_SECRET: Optional[str] = field(init=False)
+    FAKTUROID_ACCOUNT_SLUG: Optional[str] = field(init=False)
+    USER_AGENT: str = field(init=False)
+    TEMPLATES_PATH: str = field(init=False)
+    API_USERNAME: Optional[str] = field(init=False)
+    API_PASSWORD: Optional[str] = field(init=False)
+    CORS_ORIGINS: str = field(init=False)
+    cors_origins: Tuple[str, ...] = field(init=False, default=())
+    _templates: Dict[str, TemplateConfig] = field(init=False, default_factory=dict)
+    _templates_view: Mapping[str, TemplateConfig] = field(init=False)
+    _templates_file: Optional[Path] = field(init=False, default=None)
+    _api_username_digest: bytes = field(init=False, repr=False)
+    _api_password_digest: bytes = field(init=False, repr=False)
+    # Bumped on every reload, derived caches rebuild when it no longer matches
+    version: int = field(init=False, default=0)
+    # Serialized response bodies derived from templates, keyed by name
+    _payloads: Dict[str, bytes] = field(init=False, repr=False, default_factory=dict)
+    _payloads_version: int = field(init=False, repr=False, default=0)
+    _etags: Dict[str, str] = field(init=False, repr=False, default_factory=dict)
+    _template_names: Tuple[str, ...] = field(init=False, repr=False, default=())
     
-    def __init__(self):
-        if self._initialized:
-            return
-        
-        self._initialized = True
-        self._templates: Dict[str, TemplateConfig] = {}
+    def __post_init__(self):
+        self._templates_view = MappingProxyType(self._templates)
         self._load_env()
         self._load_templates()
+        self._refresh_derived()
     
     def _load_env(self):
         """Load environment variables"""
-        # Fakturoid API credentials
-        self.FAKTUROID_CLIENT_ID = os.getenv("FAKTUROID_CLIENT_ID")
-        self.FAKTUROID_CLIENT_SECRET = os.getenv("FAKTUROID_CLIENT_SECRET")
-        self.FAKTUROID_ACCOUNT_SLUG = os.getenv("FAKTUROID_ACCOUNT_SLUG")
-        self.USER_AGENT = os.getenv("USER_AGENT", "FakturoidBot (bot@example.com)")
-        self.TEMPLATES_PATH = os.getenv("TEMPLATES_PATH", "/app/config/templates.json")
+        env = {key: os.getenv(key, _ENV_DEFAULTS.get(key)) for key in _ENV_KEYS}
+        for key, value in env.items():
+            setattr(self, key, value)
         
-        # API Basic Auth credentials
-        self.API_USERNAME = os.getenv("API_USERNAME")
-        self.API_PASSWORD = os.getenv("API_PASSWORD")
+        # Credentials are compared as fixed-length digests on every request
+        self._api_username_digest = _digest(self.API_USERNAME or "")
+        self._api_password_digest = _digest(self.API_PASSWORD or "")
         
-        # Validate required env vars
-        missing = []
-        if not self.FAKTUROID_CLIENT_ID:
-            missing.append("FAKTUROID_CLIENT_ID")
-        if not self.FAKTUROID_CLIENT_SECRET:
-            missing.append("FAKTUROID_CLIENT_SECRET")
-        if not self.FAKTUROID_ACCOUNT_SLUG:
-            missing.append("FAKTUROID_ACCOUNT_SLUG")
-        if not self.API_USERNAME:
-            missing.append("API_USERNAME")
-        if not self.API_PASSWORD:
-            missing.append("API_PASSWORD")
+        origins = tuple(origin.strip() for origin in self.CORS_ORIGINS.split(",") if origin.strip())
+        self.cors_origins = origins
         
+        # Validate required env vars
+        missing = [key for key in _REQUIRED_ENV if not env[key]]
         if missing:
-            print(colored(f"✗ Missing environment variables: {', '.join(missing)}", "red"))
+            logger.error("✗ Missing environment variables: %s", ', '.join(missing))
     
     def _load_templates(self):
         """Load templates from JSON file"""
+        # Try multiple paths for flexibility, reloads reuse the path found first
+        paths_to_try = [
+            self.TEMPLATES_PATH,
+            "config/templates.json",
+            "./config/templates.json",
+            "/app/config/templates.json"
+        ]
+        path = self._templates_file or find_first_file(paths_to_try)
+        
+        if path is None:
+            logger.warning("⚠ No templates file found, tried: %s", paths_to_try)
+            return
+        
         try:
-            # Try multiple paths for flexibility
-            paths_to_try = [
-                self.TEMPLATES_PATH,
-                "config/templates.json",
-                "./config/templates.json",
-                "/app/config/templates.json"
-            ]
+            data = orjson.loads(path.read_bytes())
+            self._templates.update(_TEMPLATES_ADAPTER.validate_python(data))
             
-            loaded = False
-            for path in paths_to_try:
-                if os.path.exists(path):
-                    with open(path, "r", encoding="utf-8") as f:
-                        data = json.load(f)
-                    
-                    for name, config in data.items():
-                        self._templates[name] = TemplateConfig(**config)
-                    
-                    print(colored(f"✓ Loaded {len(self._templates)} templates from {path}", "green"))
-                    loaded = True
-                    break
+            self._templates_file = path
+            logger.info("✓ Loaded %s templates from %s", len(self._templates), path)
             
-            if not loaded:
-                print(colored(f"⚠ No templates file found, tried: {paths_to_try}", "yellow"))
-                
-        except json.JSONDecodeError as e:
-            print(colored(f"✗ Invalid JSON in templates file: {e}", "red"))
+        except orjson.JSONDecodeError as e:
+            logger.error("✗ Invalid JSON in templates file: %s", e)
+        except FileNotFoundError as e:
+            # File moved since last load, probe the candidates again next time
+            self._templates_file = None
+            logger.error("✗ Failed to load templates: %s", e)
         except Exception as e:
-            print(colored(f"✗ Failed to load templates: {e}", "red"))
+            logger.error("✗ Failed to load templates: %s", e)
+    
+    def _cached_payload(self, key: str, build: Callable[[], BaseModel]) -> bytes:
+        """Serialized response body, built once per config version"""
+        if self._payloads_version != self.version:
+            self._payloads.clear()
+            self._etags.clear()
+            self._payloads_version = self.version
+        
+        payload = self._payloads.get(key)
+        if payload is None:
+            payload = self._payloads[key] = build().model_dump_json().encode()
+        return payload
+    
+    def _cached_etag(self, key: str, build: Callable[[], BaseModel]) -> str:
+        """ETag of a cached response body, hashed once per config version"""
+        payload = self._cached_payload(key, build)
+        etag = self._etags.get(key)
+        if etag is None:
+            etag = self._etags[key] = etag_for(payload)
+        return etag
+    
+    def _refresh_derived(self):
+        """
+        Rebuild state derived from templates after a (re)load
+        
+        Response bodies are serialized now, so the first request doesn't
+        """
+        self._template_names = tuple(self._templates)
+        self._cached_etag("templates", self._build_templates_list)
+        self._cached_payload("health", self._build_health)
+    
+    def _build_templates_list(self) -> TemplatesListResponse:
+        """Build the /templates response for the currently loaded templates"""
+        return TemplatesListResponse(templates=[
+            TemplateInfo(
+                name=name,
+                generator_id=tmpl.generator_id,
+                subject_id=tmpl.subject_id,
+                due_days=tmpl.due_days,
+                description=tmpl.description
+            )
+            for name, tmpl in self._templates.items()
+        ])
+    
+    def _build_health(self) -> HealthResponse:
+        """Build the /health response for the currently loaded templates"""
+        return HealthResponse(status="healthy", templates_loaded=self.template_count)
+    
+    def credentials_match(self, username: str, password: str) -> bool:
+        """Check Basic Auth credentials in constant time"""
+        # Compare both to avoid leaking which one was wrong through timing
+        username_correct = secrets.compare_digest(_digest(username), self._api_username_digest)
+        password_correct = secrets.compare_digest(_digest(password), self._api_password_digest)
+        return username_correct and password_correct
     
     def get_template(self, name: str) -> Optional[TemplateConfig]:
         """Get template configuration by name"""
         return self._templates.get(name)
     
-    def list_templates(self) -> Dict[str, TemplateConfig]:
-        """List all available templates"""
-        return self._templates.copy()
+    @property
+    def templates_list_json(self) -> bytes:
+        """Prebuilt /templates response body, rebuilt once per config version"""
+        return self._cached_payload("templates", self._build_templates_list)
+    
+    @property
+    def templates_etag(self) -> str:
+        """ETag of the /templates response body, changes on reload"""
+        return self._cached_etag("templates", self._build_templates_list)
+    
+    @property
+    def health_json(self) -> bytes:
+        """Prebuilt /health response body, rebuilt once per config version"""
+        return self._cached_payload("health", self._build_health)
+    
+    @property
+    def template_names(self) -> Tuple[str, ...]:
+        """Names of loaded templates, rebuilt on reload"""
+        return self._template_names
+    
+    @property
+    def template_count(self) -> int:
+        """Number of loaded templates"""
+        return len(self._templates)
+    
+    def list_templates(self) -> Mapping[str, TemplateConfig]:
+        """List all available templates (read-only view, tracks reloads, no copy)"""
+        return self._templates_view
     
     def reload_templates(self):
-        """Reload templates from file"""
+        """
+        Reload templates from file (same dict, so views stay valid)
+        
+        The version is bumped even if loading fails, since the old
+        templates were dropped either way
+        """
         self._templates.clear()
         self._load_templates()
+        self.version += 1
+        self._refresh_derived()
 
 
+@lru_cache(maxsize=1)
 def get_config() -> AppConfig:
     """Get the application configuration"""
     return AppConfig()
@@ -3,15 +3,23 @@ Fakturoid API Service
 Handles OAuth authentication and API calls
 """
 
-import sys
 import time
+import asyncio
+import logging
 import base64
-import requests
-from datetime import datetime, timedelta
-from typing import Optional, Dict, Any, List
-from termcolor import colored
+import httpx
+import orjson
+from datetime import date, datetime, timedelta
+from typing import Optional, Dict, Any, AsyncIterator, List, Mapping, NamedTuple, Tuple
 
-sys.stdout.reconfigure(encoding='utf-8')
+logger = logging.getLogger(__name__)
+
+
+class GeneratorLine(NamedTuple):
+    """Pricing of a generator line, normalized once per generator fetch"""
+    unit_name: str
+    unit_price: float
+    vat_rate: Any
 
 
 class FakturoidService:
@@ -22,92 +30,272 @@ class FakturoidService:
     
     BASE_URL = "https://app.fakturoid.cz/api/v3"
     TOKEN_EXPIRY_BUFFER = 300  # Refresh 5 minutes before expiry
+    TOKEN_REFRESH_AHEAD = 600  # Background refresh runs before callers hit the buffer
+    TOKEN_RETRY_DELAY = 30  # Minimum wait between background refresh attempts
+    CONNECT_RETRIES = 3
+    MAX_CONCURRENT_REQUESTS = 10  # Stays below the client pool and Fakturoid rate limits
+    GENERATOR_CACHE_TTL = 300  # Generators are admin-managed, prices change rarely
+    SUBJECT_CACHE_TTL = 300  # Client details change even more rarely
+    PDF_CHUNK_SIZE = 64 * 1024
     
     def __init__(
         self,
         client_id: str,
         client_secret: str,
         account_slug: str,
-        user_agent: str
+        client: httpx.AsyncClient
     ):
         self.CLIENT_ID = client_id
         self.CLIENT_SECRET = client_secret
         self.ACCOUNT_SLUG = account_slug
-        self.USER_AGENT = user_agent
         
         self._access_token: Optional[str] = None
         self._token_expires_at: Optional[datetime] = None
         
-        print(colored("✓ FakturoidService initialized", "green"))
+        # Credentials never change, encode the OAuth headers once
+        credentials = base64.urlsafe_b64encode(f"{client_id}:{client_secret}".encode()).decode()
+        self._token_headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Basic {credentials}"
+        }
+        
+        # API headers are rebuilt only when the bearer token rotates
+        self._api_headers: Dict[str, str] = {}
+        self._pdf_headers: Dict[str, str] = {}
+        
+        self._token_lock = asyncio.Lock()
+        
+        # Bounds in-flight Fakturoid requests, bursts queue here instead of
+        # exhausting the connection pool. Acquire only after obtaining headers,
+        # a token refresh needs a slot of its own.
+        self._request_slots = asyncio.Semaphore(self.MAX_CONCURRENT_REQUESTS)
+        
+        # generator_id -> (fetched_at monotonic, lines by name), the raw
+        # generator payload is not kept
+        self._generator_cache: Dict[int, Tuple[float, Dict[str, GeneratorLine]]] = {}
+        
+        # subject_id -> (fetched_at monotonic, subject data)
+        self._subject_cache: Dict[int, Tuple[float, Dict[str, Any]]] = {}
+        
+        # Shared client keeps connections to Fakturoid alive between calls
+        self._client = client
+        
+        logger.info("✓ FakturoidService initialized")
     
-    def _get_basic_auth_header(self) -> str:
-        """Create Basic Auth header for OAuth"""
-        credentials = f"{self.CLIENT_ID}:{self.CLIENT_SECRET}"
-        encoded = base64.urlsafe_b64encode(credentials.encode()).decode()
-        return f"Basic {encoded}"
+    @classmethod
+    def create_client(cls, user_agent: str) -> httpx.AsyncClient:
+        """Create the pooled HTTP client shared by all Fakturoid calls"""
+        return httpx.AsyncClient(
+            headers={
+                "User-Agent": user_agent,
+                "Accept": "application/json"
+            },
+            # HTTP/2 multiplexes concurrent calls over one TLS connection,
+            # keep-alive expiry outlasts the gaps between invoice requests
+            transport=httpx.AsyncHTTPTransport(
+                http2=True,
+                retries=cls.CONNECT_RETRIES,
+                limits=httpx.Limits(
+                    max_connections=20,
+                    max_keepalive_connections=20,
+                    keepalive_expiry=60
+                )
+            )
+        )
     
-    def _get_access_token(self) -> str:
-        """Get or refresh OAuth access token"""
+    def _token_is_fresh(self) -> bool:
+        """Check whether the cached token is valid beyond the expiry buffer"""
         if self._access_token and self._token_expires_at:
-            if datetime.now() < self._token_expires_at - timedelta(seconds=self.TOKEN_EXPIRY_BUFFER):
+            return datetime.now() < self._token_expires_at - timedelta(seconds=self.TOKEN_EXPIRY_BUFFER)
+        return False
+    
+    async def _get_access_token(self) -> str:
+        """Get or refresh OAuth access token"""
+        if self._token_is_fresh():
+            return self._access_token
+        
+        # Only one coroutine refreshes, the rest wait and reuse its token
+        async with self._token_lock:
+            if self._token_is_fresh():
                 return self._access_token
+            return await self._fetch_access_token()
+    
+    async def keep_token_fresh(self):
+        """
+        Background task refreshing the access token ahead of expiry
         
-        print(colored("→ Obtaining new access token...", "yellow"))
+        Requests then always find a warm token. If a refresh fails, callers
+        still fall back to refreshing inline in _get_access_token.
+        """
+        while True:
+            try:
+                async with self._token_lock:
+                    await self._fetch_access_token()
+                refresh_at = self._token_expires_at - timedelta(seconds=self.TOKEN_REFRESH_AHEAD)
+                delay = max((refresh_at - datetime.now()).total_seconds(), self.TOKEN_RETRY_DELAY)
+            except Exception as e:
+                logger.error("✗ Background token refresh failed: %s", e)
+                delay = self.TOKEN_RETRY_DELAY
+            
+            await asyncio.sleep(delay)
+    
+    async def _fetch_access_token(self) -> str:
+        """Request a new OAuth access token"""
+        logger.debug("→ Obtaining new access token...")
         
-        response = requests.post(
-            f"{self.BASE_URL}/oauth/token",
-            headers={
-                "User-Agent": self.USER_AGENT,
-                "Content-Type": "application/json",
-                "Accept": "application/json",
-                "Authorization": self._get_basic_auth_header()
-            },
-            json={"grant_type": "client_credentials"},
-            timeout=30
-        )
+        async with self._request_slots:
+            response = await self._client.post(
+                f"{self.BASE_URL}/oauth/token",
+                headers=self._token_headers,
+                content=orjson.dumps({"grant_type": "client_credentials"}),
+                timeout=30
+            )
         
         if response.status_code != 200:
-            print(colored(f"✗ OAuth failed: {response.status_code}", "red"))
+            logger.error("✗ OAuth failed: %s", response.status_code)
             raise Exception(f"OAuth token request failed: {response.text}")
         
-        data = response.json()
+        data = orjson.loads(response.content)
         self._access_token = data["access_token"]
         expires_in = data.get("expires_in", 7200)
         self._token_expires_at = datetime.now() + timedelta(seconds=expires_in)
+        self._api_headers = {
+            "Authorization": f"Bearer {self._access_token}",
+            "Content-Type": "application/json"
+        }
+        self._pdf_headers = {
+            "Authorization": f"Bearer {self._access_token}",
+            "Accept": "application/pdf"
+        }
         
-        print(colored(f"✓ Access token obtained (expires in {expires_in}s)", "green"))
+        logger.info("✓ Access token obtained (expires in %ss)", expires_in)
         return self._access_token
     
-    def _get_headers(self) -> Dict[str, str]:
-        """Get headers with Bearer token"""
-        token = self._get_access_token()
-        return {
-            "User-Agent": self.USER_AGENT,
-            "Authorization": f"Bearer {token}",
-            "Content-Type": "application/json",
-            "Accept": "application/json"
-        }
+    async def _get_headers(self) -> Dict[str, str]:
+        """Get JSON API headers with Bearer token (shared, do not mutate)"""
+        await self._get_access_token()
+        return self._api_headers
     
-    def get_generator(self, generator_id: int) -> Dict[str, Any]:
+    async def _get_pdf_headers(self) -> Dict[str, str]:
+        """Get PDF download headers with Bearer token (shared, do not mutate)"""
+        await self._get_access_token()
+        return self._pdf_headers
+    
+    async def get_generator(self, generator_id: int) -> Dict[str, Any]:
         """
         Fetch generator template with all line details
         Returns lines with unit_price, unit_name, vat_rate
         """
         url = f"{self.BASE_URL}/accounts/{self.ACCOUNT_SLUG}/generators/{generator_id}.json"
         
-        print(colored(f"→ Fetching generator {generator_id}...", "cyan"))
+        logger.debug("→ Fetching generator %s...", generator_id)
         
-        response = requests.get(url, headers=self._get_headers(), timeout=30)
+        headers = await self._get_headers()
+        async with self._request_slots:
+            response = await self._client.get(url, headers=headers, timeout=30)
         
         if response.status_code != 200:
-            print(colored(f"✗ Failed to get generator: {response.status_code}", "red"))
+            logger.error("✗ Failed to get generator: %s", response.status_code)
             raise Exception(f"Failed to get generator: {response.text}")
         
-        data = response.json()
-        print(colored(f"✓ Generator loaded: {data.get('name', 'Unknown')}", "green"))
+        data = orjson.loads(response.content)
+        logger.debug("✓ Generator loaded: %s", data.get('name', 'Unknown'))
+        return data
+    
+    async def get_subject(self, subject_id: int) -> Dict[str, Any]:
+        """Fetch subject (customer) details"""
+        url = f"{self.BASE_URL}/accounts/{self.ACCOUNT_SLUG}/subjects/{subject_id}.json"
+        
+        logger.debug("→ Fetching subject %s...", subject_id)
+        
+        headers = await self._get_headers()
+        async with self._request_slots:
+            response = await self._client.get(url, headers=headers, timeout=30)
+        
+        if response.status_code != 200:
+            logger.error("✗ Failed to get subject: %s", response.status_code)
+            raise Exception(f"Failed to get subject: {response.text}")
+        
+        data = orjson.loads(response.content)
+        logger.debug("✓ Subject loaded: %s", data.get('name', 'Unknown'))
         return data
     
-    def create_invoice(
+    async def _get_cached_entry(
+        self,
+        generator_id: int,
+        ttl: float,
+        allow_stale: bool = True
+    ) -> Tuple[float, Dict[str, GeneratorLine]]:
+        """
+        Get cache entry (fetched_at, lines by name) for a generator, refetching when older than ttl seconds
+        
+        If a refresh fails and a stale entry exists, the stale entry is returned
+        when allow_stale is set, otherwise the error is raised
+        """
+        cached = self._generator_cache.get(generator_id)
+        if cached and time.monotonic() - cached[0] < ttl:
+            return cached
+        
+        try:
+            data = await self.get_generator(generator_id)
+        except Exception as e:
+            if cached is None or not allow_stale:
+                raise
+            logger.warning("⚠ Generator %s refresh failed, serving stale copy: %s", generator_id, e)
+            return cached
+        
+        lookup = {
+            line["name"]: GeneratorLine(
+                unit_name=line.get("unit_name", ""),
+                unit_price=to_float(line.get("unit_price")),
+                vat_rate=line.get("vat_rate", 0)
+            )
+            for line in data.get("lines", [])
+        }
+        entry = (time.monotonic(), lookup)
+        self._generator_cache[generator_id] = entry
+        return entry
+    
+    async def get_line_lookup(
+        self,
+        generator_id: int,
+        ttl: float = GENERATOR_CACHE_TTL,
+        allow_stale: bool = True
+    ) -> Mapping[str, GeneratorLine]:
+        """
+        Get generator line pricing keyed by name, cached per generator
+        
+        Pass allow_stale=False where prices must be current (invoicing), a
+        failed refresh then raises instead of serving an outdated copy
+        """
+        entry = await self._get_cached_entry(generator_id, ttl, allow_stale)
+        return entry[1]
+    
+    def invalidate_generator_cache(self, generator_id: Optional[int] = None):
+        """Drop one cached generator, or all of them when no ID is given"""
+        if generator_id is None:
+            self._generator_cache.clear()
+        else:
+            self._generator_cache.pop(generator_id, None)
+    
+    async def get_subject_cached(self, subject_id: int, ttl: float = SUBJECT_CACHE_TTL) -> Dict[str, Any]:
+        """Fetch subject, serving a cached copy younger than ttl seconds"""
+        cached = self._subject_cache.get(subject_id)
+        if cached and time.monotonic() - cached[0] < ttl:
+            return cached[1]
+        
+        data = await self.get_subject(subject_id)
+        self._subject_cache[subject_id] = (time.monotonic(), data)
+        return data
+    
+    def invalidate_subject_cache(self, subject_id: Optional[int] = None):
+        """Drop one cached subject, or all of them when no ID is given"""
+        if subject_id is None:
+            self._subject_cache.clear()
+        else:
+            self._subject_cache.pop(subject_id, None)
+    
+    async def create_invoice(
         self,
         generator_id: int,
         subject_id: int,
@@ -128,48 +316,64 @@ class FakturoidService:
             "lines": lines
         }
         
-        print(colored(f"→ Creating invoice (issued: {issued_on})...", "yellow"))
+        logger.debug("→ Creating invoice (issued: %s)...", issued_on)
         
-        response = requests.post(
-            url,
-            headers=self._get_headers(),
-            json=payload,
-            timeout=30
-        )
+        headers = await self._get_headers()
+        async with self._request_slots:
+            response = await self._client.post(
+                url,
+                headers=headers,
+                content=orjson.dumps(payload),
+                timeout=30
+            )
         
         if response.status_code not in [200, 201]:
-            print(colored(f"✗ Failed to create invoice: {response.status_code}", "red"))
+            logger.error("✗ Failed to create invoice: %s", response.status_code)
             raise Exception(f"Failed to create invoice: {response.text}")
         
-        invoice = response.json()
-        print(colored(f"✓ Invoice created: #{invoice.get('number')} (ID: {invoice.get('id')})", "green"))
+        invoice = orjson.loads(response.content)
+        logger.info("✓ Invoice created: #%s (ID: %s)", invoice.get('number'), invoice.get('id'))
         return invoice
     
-    def download_invoice_pdf(self, invoice_id: int, max_retries: int = 5, retry_delay: float = 2.0) -> bytes:
+    async def stream_invoice_pdf(
+        self,
+        invoice_id: int,
+        max_retries: int = 5,
+        retry_delay: float = 2.0
+    ) -> httpx.Response:
         """
-        Download invoice as PDF bytes
+        Open invoice PDF download and return the response with its body unread
         
-        Retries on 204 (No Content) as Fakturoid may need time to generate PDF
+        Retries on 204 (No Content) as Fakturoid may need time to generate PDF.
+        Failures are raised before the body is read, so callers can still
+        respond with an error status. The caller owns the returned response
+        and must aclose() it, even if the body is never iterated.
         """
         url = f"{self.BASE_URL}/accounts/{self.ACCOUNT_SLUG}/invoices/{invoice_id}/download.pdf"
         
-        headers = self._get_headers()
-        headers["Accept"] = "application/pdf"
+        headers = await self._get_pdf_headers()
         
-        print(colored(f"→ Downloading PDF for invoice {invoice_id}...", "yellow"))
+        logger.debug("→ Downloading PDF for invoice %s...", invoice_id)
         
         for attempt in range(max_retries):
-            response = requests.get(url, headers=headers, timeout=60)
+            request = self._client.build_request("GET", url, headers=headers, timeout=60)
+            # Slot covers the request only, the body is streamed outside it
+            async with self._request_slots:
+                response = await self._client.send(request, stream=True)
             
             if response.status_code == 200:
-                print(colored(f"✓ PDF downloaded ({len(response.content)} bytes)", "green"))
-                return response.content
+                return response
+            
+            try:
+                await response.aread()
+            finally:
+                await response.aclose()
             
             if response.status_code == 204:
                 # PDF not ready yet, retry after delay
                 if attempt < max_retries - 1:
-                    print(colored(f"  PDF not ready, retrying in {retry_delay}s... ({attempt + 1}/{max_retries})", "yellow"))
-                    time.sleep(retry_delay)
+                    logger.debug("  PDF not ready, retrying in %ss... (%s/%s)", retry_delay, attempt + 1, max_retries)
+                    await asyncio.sleep(retry_delay)
                     continue
             
             # Other error or max retries reached
@@ -178,49 +382,71 @@ class FakturoidService:
                 error_detail += f", body={response.text[:500]}"
             except Exception:
                 pass
-            print(colored(f"✗ Failed to download PDF: {error_detail}", "red"))
+            logger.error("✗ Failed to download PDF: %s", error_detail)
             raise Exception(f"Failed to download PDF: {error_detail}")
         
         raise Exception(f"Failed to download PDF after {max_retries} attempts (PDF not ready)")
     
+    async def iter_pdf_chunks(self, response: httpx.Response) -> AsyncIterator[bytes]:
+        """Yield PDF body chunks of a response from stream_invoice_pdf"""
+        size = 0
+        async for chunk in response.aiter_bytes(self.PDF_CHUNK_SIZE):
+            size += len(chunk)
+            yield chunk
+        logger.info("✓ PDF downloaded (%s bytes)", size)
+    
     def build_invoice_lines(
         self,
-        generator_lines: List[Dict[str, Any]],
+        template_lookup: Mapping[str, GeneratorLine],
         quantities: Dict[str, float]
     ) -> List[Dict[str, Any]]:
         """
         Build invoice lines by matching quantities to generator template lines
         
         Args:
-            generator_lines: Lines from generator with unit_price, unit_name, vat_rate
+            template_lookup: Generator line pricing keyed by name (see get_line_lookup)
             quantities: Mapping of line names to quantities
         
         Returns:
             List of invoice lines ready for API
+        
+        Raises:
+            ValueError: Listing every requested line missing from the generator
         """
-        # Create lookup by line name
-        template_lookup = {line["name"]: line for line in generator_lines}
-        
-        invoice_lines = []
-        for name, quantity in quantities.items():
-            if name not in template_lookup:
-                available = list(template_lookup.keys())
-                raise ValueError(f"Line '{name}' not found in generator. Available: {available}")
-            
-            template_line = template_lookup[name]
-            invoice_lines.append({
+        rows = [(name, quantity, template_lookup.get(name)) for name, quantity in quantities.items()]
+        
+        missing = [name for name, _, template_line in rows if template_line is None]
+        if missing:
+            raise ValueError(f"Lines {missing} not found in generator. Available: {sorted(template_lookup)}")
+        
+        return [
+            {
                 "name": name,
                 "quantity": quantity,
-                "unit_name": template_line.get("unit_name", ""),
-                "unit_price": float(template_line.get("unit_price", 0)),
-                "vat_rate": template_line.get("vat_rate", 0)
-            })
-        
-        return invoice_lines
+                "unit_name": unit_name,
+                "unit_price": unit_price,
+                "vat_rate": vat_rate
+            }
+            for name, quantity, (unit_name, unit_price, vat_rate) in rows
+        ]
+
+
+def to_float(value: Any) -> float:
+    """Convert a Fakturoid numeric field (float, int or decimal string) to float"""
+    # Fast path skips the float() call for values that are already floats
+    return value if type(value) is float else float(value or 0)
+
+
+# (today, formatted result) - the result only changes when the date does
+_last_day_cache: Optional[Tuple[date, str]] = None
 
 
 def get_last_day_of_previous_month() -> str:
     """Get last day of previous month in YYYY-MM-DD format"""
-    first_of_current = datetime.now().replace(day=1)
-    last_of_previous = first_of_current - timedelta(days=1)
-    return last_of_previous.strftime("%Y-%m-%d")
+    global _last_day_cache
+    
+    today = date.today()
+    if _last_day_cache is None or _last_day_cache[0] != today:
+        last_of_previous = today.replace(day=1) - timedelta(days=1)
+        _last_day_cache = (today, last_of_previous.strftime("%Y-%m-%d"))
+    return _last_day_cache[1]
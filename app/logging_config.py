@@ -0,0 +1,72 @@
+"""
+Logging Setup
+Console logging for the app, colored by level when attached to a terminal
+"""
+
+import sys
+import queue
+import atexit
+import logging
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
+from termcolor import colored
+
+
+LEVEL_COLORS = {
+    logging.DEBUG: "cyan",
+    logging.INFO: "green",
+    logging.WARNING: "yellow",
+    logging.ERROR: "red",
+    logging.CRITICAL: "red",
+}
+
+# Background thread writing queued records to the console
+_listener: Optional[QueueListener] = None
+
+
+class ColoredFormatter(logging.Formatter):
+    """Formatter wrapping each message in its level color"""
+    
+    def format(self, record: logging.LogRecord) -> str:
+        return colored(super().format(record), LEVEL_COLORS.get(record.levelno))
+
+
+def setup_logging(level: str = "INFO"):
+    """
+    Configure the "app" logger hierarchy once
+    
+    Records are handed to a queue and written by a listener thread, so a
+    slow stdout never blocks the event loop. Colors are only added on a
+    TTY, production logs stay plain text.
+    """
+    global _listener
+    
+    sys.stdout.reconfigure(encoding="utf-8")
+    
+    handler = logging.StreamHandler(sys.stdout)
+    if sys.stdout.isatty():
+        handler.setFormatter(ColoredFormatter("%(message)s"))
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    
+    stop_logging()
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    _listener = QueueListener(log_queue, handler)
+    _listener.start()
+    
+    logger = logging.getLogger("app")
+    logger.handlers[:] = [QueueHandler(log_queue)]
+    logger.setLevel(level.upper())
+    logger.propagate = False
+
+
+def stop_logging():
+    """Flush queued records and stop the listener thread"""
+    global _listener
+    
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(stop_logging)
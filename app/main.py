@@ -4,57 +4,85 @@ FastAPI application for creating invoices from configurable templates
 """
 
 import os
-import sys
-import secrets
-from contextlib import asynccontextmanager
-from typing import Annotated
+import asyncio
+import logging
+from contextlib import asynccontextmanager, suppress
+from typing import Annotated, AsyncIterator, Optional
 
-from fastapi import FastAPI, HTTPException, Path, Depends, status
+import httpx
+import orjson
+from fastapi import FastAPI, HTTPException, Path, Depends, Request, status
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from starlette.middleware.gzip import DEFAULT_EXCLUDED_CONTENT_TYPES
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
-from fastapi.responses import PlainTextResponse
-from termcolor import colored
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
+from starlette.types import Receive, Scope, Send
 from dotenv import load_dotenv
 
-from app.config import get_config, AppConfig
+from app.config import get_config, find_first_file, etag_for, AppConfig
 from app.models import (
     InvoiceRequest,
     InvoiceResponse,
-    InvoiceLine,
     ErrorResponse,
-    TemplateInfo,
+    TemplateDetails,
     TemplatesListResponse,
     HealthResponse
 )
-from app.fakturoid_service import FakturoidService, get_last_day_of_previous_month
-
-sys.stdout.reconfigure(encoding='utf-8')
+from app.fakturoid_service import FakturoidService, get_last_day_of_previous_month, to_float
+from app.logging_config import setup_logging
 
 # Load environment variables
 load_dotenv()
 
+# Configure logging before config loading reports anything
+setup_logging(os.getenv("LOG_LEVEL", "INFO"))
+logger = logging.getLogger(__name__)
+
+# Single configuration instance for the process (templates reload in place), bind it once
+CONFIG: AppConfig = get_config()
+
 # Global service instance
 FAKTUROID_SERVICE: FakturoidService = None
 
+# Cache TTLs per endpoint (seconds): invoices need current prices,
+# template details only list line names and the client name
+INVOICE_GENERATOR_TTL = 60
+DETAILS_CACHE_TTL = FakturoidService.GENERATOR_CACHE_TTL
+
 # HTTP Basic Auth
 security = HTTPBasic()
 
 
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Check an If-None-Match header against an ETag (weak comparison, as RFC 9110 requires)"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque_tag = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == opaque_tag for tag in if_none_match.split(","))
+
+
+def etag_response(request: Request, body: bytes, etag: Optional[str] = None) -> Response:
+    """
+    Return a JSON body with its ETag, or an empty 304 if the client has it cached
+    
+    Pass a precomputed etag for cached bodies, otherwise the body is hashed.
+    Returning a Response skips FastAPI's response_model re-validation,
+    the route's response_model is still used for the OpenAPI schema
+    """
+    if etag is None:
+        etag = etag_for(body)
+    headers = {"ETag": etag}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
 def verify_credentials(credentials: Annotated[HTTPBasicCredentials, Depends(security)]):
     """Verify HTTP Basic Auth credentials"""
-    config = get_config()
-    
-    # Use secrets.compare_digest to prevent timing attacks
-    username_correct = secrets.compare_digest(
-        credentials.username.encode("utf-8"),
-        config.API_USERNAME.encode("utf-8")
-    )
-    password_correct = secrets.compare_digest(
-        credentials.password.encode("utf-8"),
-        config.API_PASSWORD.encode("utf-8")
-    )
-    
-    if not (username_correct and password_correct):
+    if not CONFIG.credentials_match(credentials.username, credentials.password):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid credentials",
@@ -64,43 +92,74 @@ def verify_credentials(credentials: Annotated[HTTPBasicCredentials, Depends(secu
     return credentials.username
 
 
+class UpstreamStreamingResponse(StreamingResponse):
+    """
+    Stream the body of an open upstream httpx response
+    
+    The upstream response is closed however sending ends (finished, client
+    disconnect, cancellation), including when the body is never iterated,
+    so its pooled connection is always released.
+    """
+    
+    def __init__(self, upstream: httpx.Response, content: AsyncIterator[bytes], **kwargs):
+        super().__init__(content, **kwargs)
+        self.upstream = upstream
+    
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            # No-op if the stream was already closed
+            await self.upstream.aclose()
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Application lifespan - initialize services on startup"""
     global FAKTUROID_SERVICE
     
-    print(colored("\n═══ FAKTUROID INVOICE API ═══\n", "blue", attrs=["bold"]))
-    
-    config = get_config()
+    logger.info("═══ FAKTUROID INVOICE API ═══")
     
     # Validate configuration
-    if not config.FAKTUROID_CLIENT_ID or not config.FAKTUROID_CLIENT_SECRET:
-        print(colored("✗ Missing Fakturoid credentials in environment", "red"))
+    if not CONFIG.FAKTUROID_CLIENT_ID or not CONFIG.FAKTUROID_CLIENT_SECRET:
+        logger.error("✗ Missing Fakturoid credentials in environment")
         raise RuntimeError("Missing FAKTUROID_CLIENT_ID or FAKTUROID_CLIENT_SECRET")
     
-    if not config.FAKTUROID_ACCOUNT_SLUG:
-        print(colored("✗ Missing FAKTUROID_ACCOUNT_SLUG in environment", "red"))
+    if not CONFIG.FAKTUROID_ACCOUNT_SLUG:
+        logger.error("✗ Missing FAKTUROID_ACCOUNT_SLUG in environment")
         raise RuntimeError("Missing FAKTUROID_ACCOUNT_SLUG")
     
-    if not config.API_USERNAME or not config.API_PASSWORD:
-        print(colored("✗ Missing API_USERNAME or API_PASSWORD in environment", "red"))
+    if not CONFIG.API_USERNAME or not CONFIG.API_PASSWORD:
+        logger.error("✗ Missing API_USERNAME or API_PASSWORD in environment")
         raise RuntimeError("Missing API_USERNAME or API_PASSWORD")
     
-    print(colored(f"✓ Basic auth enabled (user: {config.API_USERNAME})", "green"))
+    logger.info("✓ Basic auth enabled (user: %s)", CONFIG.API_USERNAME)
     
-    # Initialize Fakturoid service
+    # Initialize Fakturoid service with a shared async HTTP client
+    http_client = FakturoidService.create_client(CONFIG.USER_AGENT)
     FAKTUROID_SERVICE = FakturoidService(
-        client_id=config.FAKTUROID_CLIENT_ID,
-        client_secret=config.FAKTUROID_CLIENT_SECRET,
-        account_slug=config.FAKTUROID_ACCOUNT_SLUG,
-        user_agent=config.USER_AGENT
+        client_id=CONFIG.FAKTUROID_CLIENT_ID,
+        client_secret=CONFIG.FAKTUROID_CLIENT_SECRET,
+        account_slug=CONFIG.FAKTUROID_ACCOUNT_SLUG,
+        client=http_client
     )
     
-    print(colored(f"✓ API ready with {len(config.list_templates())} templates\n", "green"))
+    # Obtain the first token now and keep refreshing it off the request path
+    token_refresher = asyncio.create_task(FAKTUROID_SERVICE.keep_token_fresh())
+    
+    # Skill documentation is static, read it once
+    app.state.skill_doc = load_skill_documentation()
+    
+    logger.info("✓ API ready with %s templates", CONFIG.template_count)
     
     yield
     
-    print(colored("\n✓ Shutting down...", "yellow"))
+    logger.info("✓ Shutting down...")
+    token_refresher.cancel()
+    with suppress(asyncio.CancelledError):
+        await token_refresher
+    await http_client.aclose()
+    # The log listener lives as long as the process, logging_config stops it at exit
 
 
 # Create FastAPI app
@@ -111,13 +170,25 @@ app = FastAPI(
     lifespan=lifespan
 )
 
-# CORS middleware
+# CORS middleware, only for explicitly configured origins. Credentialed
+# (Basic auth) browser requests must not be allowed from arbitrary sites.
+if CONFIG.cors_origins:
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=list(CONFIG.cors_origins),
+        allow_credentials=True,
+        allow_methods=["GET", "POST"],
+        allow_headers=["content-type", "authorization", "if-none-match"],
+        # Lets browser clients read the ETag for conditional requests
+        expose_headers=["ETag"],
+    )
+
+# Compress JSON responses, small bodies aren't worth the CPU and PDFs are
+# already compressed
 app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    GZipMiddleware,
+    minimum_size=1024,
+    exclude_content_types=(*DEFAULT_EXCLUDED_CONTENT_TYPES, "application/pdf")
 )
 
 
@@ -125,13 +196,8 @@ app.add_middleware(
 SKILL_FILE_PATH = os.getenv("SKILL_FILE_PATH", "/app/CLAUDE_SKILL.md")
 
 
-@app.get("/", response_class=PlainTextResponse, tags=["Documentation"])
-async def get_skill_documentation(username: Annotated[str, Depends(verify_credentials)]):
-    """
-    Get API skill documentation (CLAUDE_SKILL.md)
-    
-    Returns the skill documentation in markdown format for AI assistants
-    """
+def load_skill_documentation() -> Optional[str]:
+    """Read skill documentation from the first existing path, None if missing"""
     # Try multiple paths
     paths_to_try = [
         SKILL_FILE_PATH,
@@ -140,90 +206,121 @@ async def get_skill_documentation(username: Annotated[str, Depends(verify_creden
         "/app/CLAUDE_SKILL.md"
     ]
     
-    for path in paths_to_try:
-        if os.path.exists(path):
-            with open(path, "r", encoding="utf-8") as f:
-                return f.read()
+    path = find_first_file(paths_to_try)
+    return path.read_text(encoding="utf-8") if path else None
+
+
+@app.get("/", response_class=PlainTextResponse, tags=["Documentation"])
+async def get_skill_documentation(
+    username: Annotated[str, Depends(verify_credentials)],
+    request: Request
+):
+    """
+    Get API skill documentation (CLAUDE_SKILL.md)
     
-    raise HTTPException(
-        status_code=404,
-        detail="Skill documentation not found"
-    )
+    Returns the skill documentation in markdown format for AI assistants
+    """
+    if request.app.state.skill_doc is None:
+        raise HTTPException(
+            status_code=404,
+            detail="Skill documentation not found"
+        )
+    return request.app.state.skill_doc
 
 
 @app.get("/health", response_model=HealthResponse, tags=["Health"])
 async def health_check():
     """Health check endpoint"""
-    config = get_config()
-    return HealthResponse(
-        status="healthy",
-        templates_loaded=len(config.list_templates())
-    )
+    # Payload only changes on template reload, serve the prebuilt bytes
+    return Response(content=CONFIG.health_json, media_type="application/json")
 
 
-@app.get("/templates", response_model=TemplatesListResponse, tags=["Templates"])
-async def list_templates(username: Annotated[str, Depends(verify_credentials)]):
+@app.get(
+    "/templates",
+    response_model=TemplatesListResponse,
+    responses={304: {"description": "Not Modified (If-None-Match matched the ETag)"}},
+    tags=["Templates"]
+)
+async def list_templates(
+    username: Annotated[str, Depends(verify_credentials)],
+    request: Request
+):
     """
     List all available invoice templates
     
-    Returns template names and their configuration (without fetching line details)
+    Returns template names and their configuration (without fetching line details).
+    The ETag only changes on template reload, send it as If-None-Match to get a 304.
     """
-    config = get_config()
-    templates = config.list_templates()
-    
-    template_list = []
-    for name, tmpl in templates.items():
-        template_list.append(TemplateInfo(
-            name=name,
-            generator_id=tmpl.generator_id,
-            subject_id=tmpl.subject_id,
-            due_days=tmpl.due_days,
-            description=tmpl.description
-        ))
-    
-    return TemplatesListResponse(templates=template_list)
+    # Payload and its ETag are built once per (re)load, serve them as-is
+    return etag_response(request, CONFIG.templates_list_json, CONFIG.templates_etag)
 
 
 @app.get(
     "/templates/{template_name}",
-    response_model=TemplateInfo,
-    responses={404: {"model": ErrorResponse}},
+    response_model=TemplateDetails,
+    responses={
+        304: {"description": "Not Modified (If-None-Match matched the ETag)"},
+        404: {"model": ErrorResponse}
+    },
     tags=["Templates"]
 )
 async def get_template_details(
     username: Annotated[str, Depends(verify_credentials)],
+    request: Request,
     template_name: str = Path(..., description="Template name from configuration")
 ):
     """
     Get template details including available line names from Fakturoid
     
-    Fetches the generator from Fakturoid to show available lines that can be invoiced
+    Fetches the generator (cached) and subject from Fakturoid concurrently to show
+    available lines that can be invoiced. Either lookup may fail independently,
+    its field is then left empty. Send the returned ETag as If-None-Match to get
+    a 304 while the details are unchanged.
     """
-    config = get_config()
-    template = config.get_template(template_name)
+    template = CONFIG.get_template(template_name)
     
     if not template:
         raise HTTPException(
             status_code=404,
-            detail=f"Template '{template_name}' not found. Available: {list(config.list_templates().keys())}"
+            detail=f"Template '{template_name}' not found. Available: {', '.join(CONFIG.template_names)}"
         )
     
-    # Fetch generator to get line names
-    try:
-        generator = FAKTUROID_SERVICE.get_generator(template.generator_id)
-        available_lines = [line["name"] for line in generator.get("lines", [])]
-    except Exception as e:
-        available_lines = None
-        print(colored(f"⚠ Could not fetch generator lines: {e}", "yellow"))
+    # Independent cached lookups, on a miss one round trip of the slowest
+    # instead of their sum
+    line_lookup, subject = await asyncio.gather(
+        FAKTUROID_SERVICE.get_line_lookup(template.generator_id, ttl=DETAILS_CACHE_TTL),
+        FAKTUROID_SERVICE.get_subject_cached(template.subject_id, ttl=DETAILS_CACHE_TTL),
+        return_exceptions=True
+    )
+    
+    # Cancellation is not a lookup failure, let it propagate
+    for result in (line_lookup, subject):
+        if isinstance(result, asyncio.CancelledError):
+            raise result
+    
+    available_lines = None
+    if isinstance(line_lookup, BaseException):
+        logger.warning("⚠ Could not fetch generator lines: %s", line_lookup)
+    else:
+        available_lines = list(line_lookup)
     
-    return TemplateInfo(
+    subject_name = None
+    if isinstance(subject, BaseException):
+        logger.warning("⚠ Could not fetch subject: %s", subject)
+    else:
+        subject_name = subject.get("name")
+    
+    details = TemplateDetails(
         name=template_name,
         generator_id=template.generator_id,
         subject_id=template.subject_id,
+        subject_name=subject_name,
         due_days=template.due_days,
         description=template.description,
         available_lines=available_lines
     )
+    # Details include live Fakturoid data, so the ETag is a hash of this body
+    return etag_response(request, details.model_dump_json().encode())
 
 
 @app.post(
@@ -249,18 +346,17 @@ async def create_invoice(
     
     The invoice will be created with:
     - Issue date: Last day of previous month
-    - Line prices: Fetched from Fakturoid generator template
+    - Line prices: Fetched from Fakturoid generator template (cached for up to a minute)
     - Line quantities: From request body
     
     Returns invoice metadata (total, lines, etc.) - use /invoice/{id}/pdf to download PDF
     """
-    config = get_config()
-    template = config.get_template(template_name)
+    template = CONFIG.get_template(template_name)
     
     if not template:
         raise HTTPException(
             status_code=404,
-            detail=f"Template '{template_name}' not found. Available: {list(config.list_templates().keys())}"
+            detail=f"Template '{template_name}' not found. Available: {', '.join(CONFIG.template_names)}"
         )
     
     if not request.lines:
@@ -271,10 +367,14 @@ async def create_invoice(
     
     try:
         # 1. Fetch generator to get current prices
-        generator = FAKTUROID_SERVICE.get_generator(template.generator_id)
-        generator_lines = generator.get("lines", [])
+        # Never invoice at stale prices, a failed refresh fails the request
+        line_lookup = await FAKTUROID_SERVICE.get_line_lookup(
+            template.generator_id,
+            ttl=INVOICE_GENERATOR_TTL,
+            allow_stale=False
+        )
         
-        if not generator_lines:
+        if not line_lookup:
             raise HTTPException(
                 status_code=400,
                 detail=f"Generator {template.generator_id} has no lines configured"
@@ -282,13 +382,13 @@ async def create_invoice(
         
         # 2. Build invoice lines (match quantities to template prices)
         invoice_lines = FAKTUROID_SERVICE.build_invoice_lines(
-            generator_lines=generator_lines,
+            template_lookup=line_lookup,
             quantities=request.lines
         )
         
         # 3. Create invoice
         issue_date = get_last_day_of_previous_month()
-        invoice = FAKTUROID_SERVICE.create_invoice(
+        invoice = await FAKTUROID_SERVICE.create_invoice(
             generator_id=template.generator_id,
             subject_id=template.subject_id,
             lines=invoice_lines,
@@ -297,30 +397,34 @@ async def create_invoice(
         )
         
         # 4. Build response (no PDF - use /invoice/{id}/pdf endpoint)
+        # Plain dicts shaped like InvoiceResponse, encoded by orjson. Returning
+        # a Response skips response_model re-validation, the model still
+        # documents the schema
         response_lines = [
-            InvoiceLine(
-                name=line["name"],
-                quantity=float(line["quantity"]),
-                unit_name=line.get("unit_name", ""),
-                unit_price=float(line.get("unit_price", 0)),
-                vat_rate=float(line.get("vat_rate", 0))
-            )
+            {
+                "name": line["name"],
+                "quantity": to_float(line["quantity"]),
+                "unit_name": line.get("unit_name", ""),
+                "unit_price": to_float(line.get("unit_price")),
+                "vat_rate": to_float(line.get("vat_rate"))
+            }
             for line in invoice.get("lines", [])
         ]
         
         invoice_number = invoice["number"]
-        return InvoiceResponse(
-            success=True,
-            invoice_id=invoice["id"],
-            invoice_number=invoice_number,
-            filename=f"{config.FAKTUROID_ACCOUNT_SLUG}-{invoice_number}.pdf",
-            total=float(invoice.get("total", 0)),
-            currency=invoice.get("currency", "CZK"),
-            issued_on=invoice.get("issued_on", issue_date),
-            due_on=invoice.get("due_on", ""),
-            lines=response_lines,
-            pdf_url=f"/invoice/{invoice['id']}/pdf"
-        )
+        body = {
+            "success": True,
+            "invoice_id": invoice["id"],
+            "invoice_number": invoice_number,
+            "filename": f"{CONFIG.FAKTUROID_ACCOUNT_SLUG}-{invoice_number}.pdf",
+            "total": to_float(invoice.get("total")),
+            "currency": invoice.get("currency", "CZK"),
+            "issued_on": invoice.get("issued_on", issue_date),
+            "due_on": invoice.get("due_on", ""),
+            "lines": response_lines,
+            "pdf_url": f"/invoice/{invoice['id']}/pdf"
+        }
+        return Response(content=orjson.dumps(body), media_type="application/json")
         
     except ValueError as e:
         # Line name mismatch
@@ -328,7 +432,7 @@ async def create_invoice(
     except HTTPException:
         raise
     except Exception as e:
-        print(colored(f"✗ Error creating invoice: {e}", "red"))
+        logger.error("✗ Error creating invoice: %s", e)
         raise HTTPException(
             status_code=500,
             detail=f"Failed to create invoice: {str(e)}"
@@ -350,42 +454,44 @@ async def download_invoice_pdf(
     """
     Download invoice PDF
     
-    Returns the PDF file directly (application/pdf content type).
+    Streams the PDF file directly from Fakturoid (application/pdf content type).
     Use after creating invoice and validating the total amount.
     
     Pipe directly to file: curl ... > invoice.pdf
     """
-    from fastapi.responses import Response
-    
     try:
-        pdf_bytes = FAKTUROID_SERVICE.download_invoice_pdf(invoice_id)
-        
-        return Response(
-            content=pdf_bytes,
-            media_type="application/pdf",
-            headers={
-                "Content-Disposition": f"attachment; filename=invoice_{invoice_id}.pdf"
-            }
-        )
-        
+        pdf_response = await FAKTUROID_SERVICE.stream_invoice_pdf(invoice_id)
     except Exception as e:
-        print(colored(f"✗ Error downloading PDF: {e}", "red"))
+        logger.error("✗ Error downloading PDF: %s", e)
         raise HTTPException(
             status_code=500,
             detail=f"Failed to download PDF: {str(e)}"
         )
+    
+    # From here on the response owns the upstream connection and closes it
+    return UpstreamStreamingResponse(
+        pdf_response,
+        FAKTUROID_SERVICE.iter_pdf_chunks(pdf_response),
+        media_type="application/pdf",
+        headers={"Content-Disposition": f"attachment; filename=invoice_{invoice_id}.pdf"}
+    )
 
 
 @app.post("/templates/reload", tags=["Templates"])
-async def reload_templates(username: Annotated[str, Depends(verify_credentials)]):
+async def reload_templates(
+    username: Annotated[str, Depends(verify_credentials)]
+):
     """
     Reload templates from configuration file
     
-    Use this after modifying templates.json without restarting the server
+    Use this after modifying templates.json without restarting the server.
+    Also drops cached generators and subjects so the next requests fetch
+    current prices and client names.
     """
-    config = get_config()
-    config.reload_templates()
+    CONFIG.reload_templates()
+    FAKTUROID_SERVICE.invalidate_generator_cache()
+    FAKTUROID_SERVICE.invalidate_subject_cache()
     return {
         "success": True,
-        "message": f"Reloaded {len(config.list_templates())} templates"
+        "message": f"Reloaded {CONFIG.template_count} templates"
     }
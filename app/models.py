@@ -3,11 +3,13 @@ Pydantic Models for API Request/Response
 """
 
 from typing import Dict, Optional, List
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 
 
 class InvoiceRequest(BaseModel):
     """Request model for creating an invoice"""
+    model_config = ConfigDict(extra="ignore")
+    
     lines: Dict[str, float] = Field(
         ...,
         description="Mapping of line names to quantities (e.g., hours)",
@@ -17,6 +19,8 @@ class InvoiceRequest(BaseModel):
 
 class InvoiceLine(BaseModel):
     """Single invoice line item"""
+    model_config = ConfigDict(frozen=True)
+    
     name: str
     quantity: float
     unit_name: str
@@ -26,6 +30,8 @@ class InvoiceLine(BaseModel):
 
 class InvoiceResponse(BaseModel):
     """Response model for created invoice (metadata only, no PDF)"""
+    model_config = ConfigDict(frozen=True)
+    
     success: bool
     invoice_id: int
     invoice_number: str
@@ -40,6 +46,8 @@ class InvoiceResponse(BaseModel):
 
 class ErrorResponse(BaseModel):
     """Error response model"""
+    model_config = ConfigDict(frozen=True)
+    
     success: bool = False
     error: str
     detail: Optional[str] = None
@@ -47,6 +55,8 @@ class ErrorResponse(BaseModel):
 
 class TemplateInfo(BaseModel):
     """Template information for listing"""
+    model_config = ConfigDict(frozen=True)
+    
     name: str
     generator_id: int
     subject_id: int
@@ -55,12 +65,21 @@ class TemplateInfo(BaseModel):
     available_lines: Optional[List[str]] = None
 
 
+class TemplateDetails(TemplateInfo):
+    """Template information with live Fakturoid data, for a single template"""
+    subject_name: Optional[str] = None
+
+
 class TemplatesListResponse(BaseModel):
     """Response for listing available templates"""
+    model_config = ConfigDict(frozen=True)
+    
     templates: List[TemplateInfo]
 
 
 class HealthResponse(BaseModel):
     """Health check response"""
+    model_config = ConfigDict(frozen=True)
+    
     status: str
     templates_loaded: int